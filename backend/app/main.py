@@ -3,14 +3,19 @@ from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Literal
 import asyncio
+import contextlib
+import time
 
 # --- App Imports ---
-from app.database import get_db
-from app.services.model_manager import model_manager
-from app.services.cache_service import find_cached_response, save_to_cache_task 
+from app.database import get_db, AsyncSessionLocal
+from app.services.model_manager import model_manager, token_stats, PromptTooLongError
+from app.services.cache_service import find_cached_response, save_to_cache_task, cache_write_stats
 from app.services.auth_service import auth_service, get_current_api_key
+from app.services.shm_cache import response_cache, embedding_cache, response_key
+from app.services.trace_service import trace_recorder
+from app.services.log_service import logger
 from app.models import APIKey
 
 app = FastAPI(title="AI Platform Core", version="1.0.0")
@@ -34,11 +39,40 @@ LOCAL_SECRET = "super-secret-bridge-token-123"
 # Ensures only ONE request touches the GPU at a time to prevent vLLM crashes.
 gpu_lock = asyncio.Lock()
 
+# How long a request that reached the GPU waits for its still-running cache lookup
+CACHE_LOOKUP_GRACE = 0.05
+
+# Where semantic cache hits were served from (see generate_text), exposed via /admin/stats
+pipeline_stats = {
+    "hits_while_queued": 0,
+    "hits_at_gpu": 0,
+    "misses": 0,
+}
+
+@app.on_event("startup")
+def attach_shared_caches():
+    # Attach (and honour SHM_CACHE_RESET) before traffic, not on the first request
+    response_cache.initialize()
+    embedding_cache.initialize()
+
+@app.on_event("shutdown")
+def flush_on_shutdown():
+    trace_recorder.flush()
+    logger.flush()
+
+# While a drain-mode swap is running, new requests wait this long for the GPU
+# (cache hits are still served immediately) before getting a 503.
+SWAP_HOLD_DEADLINE = 120.0
+# Swap phases during which the GPU is (about to be) unavailable
+SWAP_HOLD_PHASES = ("draining", "unloading", "loading")
+held_requests = {"count": 0}
+
 # --- Pydantic Models ---
 class LoadModelRequest(BaseModel):
     model_id: str
     model_path: str
     quantization: Optional[str] = "awq" # Supports 'None' for standard weights
+    swap_mode: Literal["auto", "drain"] = "auto" # 'auto' preloads next to the old model when VRAM allows
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -60,9 +94,29 @@ async def health_check():
     return {
         "status": "ok", 
         "current_model": model_manager.current_model_name,
-        "gpu_locked": gpu_lock.locked() 
+        "gpu_locked": gpu_lock.locked(),
+        "swap_phase": model_manager.swap_status["phase"]
+    }
+
+@app.get("/admin/stats")
+async def get_stats():
+    """Process-local counters (per uvicorn worker)."""
+    return {
+        "cache_writes": cache_write_stats,
+        "tokens": token_stats,
+        "cache_pipeline": pipeline_stats,
+        "shm_response_cache": response_cache.stats,
+        "shm_embedding_cache": embedding_cache.stats,
+        "logging": logger.stats
     }
 
+@app.post("/admin/shm-cache/clear")
+async def clear_shm_cache():
+    """Empties the shared exact-match and embedding caches for every worker on this host."""
+    response_cache.clear()
+    embedding_cache.clear()
+    return {"status": "cleared"}
+
 # --- 🔑 API Key Management (Admin Only) ---
 
 @app.post("/admin/keys")
@@ -118,31 +172,137 @@ async def revoke_api_key(key_id: int, db: AsyncSession = Depends(get_db)):
 @app.post("/admin/load-model")
 async def load_model_endpoint(request: LoadModelRequest):
     """
-    Triggers a model swap.
-    Acquires the lock to ensure no generation is happening while swapping.
+    Triggers a model swap without taking the API offline.
+    - Enough free VRAM ('auto'): the new model is preloaded into the free VRAM while
+      the old one keeps serving, then swapped in under the lock (only in-flight generation is waited on).
+    - Otherwise ('drain'): in-flight requests finish, new ones are held (up to
+      SWAP_HOLD_DEADLINE, served from cache when possible), then unload + load.
+    Progress: GET /admin/swap-status
     """
-    async with gpu_lock:
-        try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: model_manager.load_model(
-                    model_path=request.model_path,
-                    model_id=request.model_id,
-                    quantization=request.quantization
+    status = model_manager.swap_status
+    if status["phase"] not in ("idle", "done", "failed"):
+        raise HTTPException(status_code=409, detail=f"Swap already in progress ({status['phase']}).")
+    if model_manager.llm and model_manager.current_model_name == request.model_id:
+        return {"status": "success", "message": f"{request.model_id} already loaded"}
+
+    loop = asyncio.get_event_loop()
+    preload_utilization = None
+    if request.swap_mode == "auto" and model_manager.llm:
+        preload_utilization = model_manager.preload_memory_utilization(request.model_path)
+    mode = "preload" if preload_utilization else "drain"
+    status.update(
+        mode=mode,
+        from_model=model_manager.current_model_name,
+        to_model=request.model_id,
+        started_at=time.time(),
+        finished_at=None,
+        error=None
+    )
+
+    # Whatever happens below (errors, cancellation), the phase must not stay mid-swap:
+    # that would block later swaps (409) and keep /generate in holding mode.
+    try:
+        # --- Preload path: old model serves until cutover ---
+        if mode == "preload":
+            preload_failed = False
+            try:
+                model_manager.set_swap_phase("preloading")
+                llm, tokenizer = await loop.run_in_executor(
+                    None,
+                    model_manager.preload,
+                    request.model_path,
+                    request.model_id,
+                    request.quantization,
+                    preload_utilization
                 )
-            )
-            return {"status": "success", "message": f"Loaded {request.model_id}"}
-        except Exception as e:
+            except Exception as e:
+                logger.warning("model_preload_failed", model=request.model_id, error=str(e))
+                preload_failed = True
+
+            if preload_failed:
+                # Two engines didn't fit after all: drop the half-built one, then drain.
+                # (Done outside the except block, whose traceback kept it alive.)
+                await loop.run_in_executor(None, model_manager.free_gpu_memory)
+                model_manager.swap_status["mode"] = mode = "drain"
+
+        if mode == "preload":
+            model_manager.set_swap_phase("cutover")
+            async with gpu_lock:
+                model_manager.activate(request.model_id, llm, tokenizer)
+            model_manager.set_swap_phase("releasing")
+            await loop.run_in_executor(None, model_manager.release_retired)
+
+        # --- Drain path: hold new requests, swap, release them ---
+        else:
+            model_manager.set_swap_phase("draining")
+            async with gpu_lock:
+                model_manager.set_swap_phase("unloading")
+                await loop.run_in_executor(None, model_manager.unload_model)
+                model_manager.set_swap_phase("loading")
+                await loop.run_in_executor(
+                    None,
+                    lambda: model_manager.load_model(
+                        model_path=request.model_path,
+                        model_id=request.model_id,
+                        quantization=request.quantization
+                    )
+                )
+    except BaseException as e:
+        model_manager.set_swap_phase("failed", error=str(e) or type(e).__name__)
+        if isinstance(e, Exception):
             raise HTTPException(status_code=500, detail=str(e))
+        raise
+
+    model_manager.set_swap_phase("done")
+    return {"status": "success", "message": f"Loaded {request.model_id}", "mode": mode}
+
+@app.get("/admin/swap-status")
+async def swap_status():
+    return {
+        **model_manager.swap_status,
+        "current_model": model_manager.current_model_name,
+        "held_requests": held_requests["count"],
+        "gpu_locked": gpu_lock.locked()
+    }
 
 # --- 💬 Inference (Secured) ---
 
+async def semantic_lookup(prompt: str, model: str):
+    """
+    Returns the cached response text, or None on a miss.
+    Uses its own session: the task may be cancelled mid-query, and must not
+    take the request-scoped session down with it.
+    """
+    async with AsyncSessionLocal() as db:
+        cached_entry = await find_cached_response(db, prompt, model)
+        return cached_entry.response_text if cached_entry else None
+
+async def stop_lookup(lookup: asyncio.Task):
+    """Cancels the lookup and waits for it, so its DB connection is cleaned up before we return."""
+    lookup.cancel()
+    # Exceptions were already reported by lookup_result(); only cleanup matters here
+    with contextlib.suppress(asyncio.CancelledError, Exception):
+        await lookup
+
+def lookup_result(lookup: asyncio.Task):
+    """Result of a finished lookup task; failures count as a miss."""
+    if not lookup.done() or lookup.cancelled():
+        return None
+    if lookup.exception():
+        logger.warning("cache_lookup_failed", error=str(lookup.exception()))
+        return None
+    return lookup.result()
+
+def leave_gpu_queue(acquire: asyncio.Future):
+    """Drops a pending gpu_lock.acquire(), releasing the lock if it was already granted."""
+    if acquire.cancel() or acquire.cancelled():
+        return
+    gpu_lock.release()
+
 @app.post("/generate")
 async def generate_text(
     request: GenerateRequest, 
     background_tasks: BackgroundTasks,
-    db: AsyncSession = Depends(get_db),
     # 👇 SECURITY CHECK: 
     # 1. Checks for 'x-internal-secret' (from Cloud Gateway)
     # 2. OR checks for 'api_key' (if you enable it later for direct access)
@@ -151,50 +311,164 @@ async def generate_text(
     # --- 1. Cloud Tunnel Security ---
     # Only allow requests that have the correct "Secret Handshake"
     if x_internal_secret != LOCAL_SECRET:
-        print(f"🛑 Unauthorized access attempt. Token: {x_internal_secret}")
+        logger.warning("unauthorized", token_present=x_internal_secret is not None)
         raise HTTPException(status_code=403, detail="Unauthorized GPU Access. Missing Secret.")
 
     # --- 2. Model Check ---
-    if not model_manager.llm:
+    # During a drain-mode swap there may briefly be no model: hold the request instead of failing.
+    holding = model_manager.swap_status["phase"] in SWAP_HOLD_PHASES
+    if not model_manager.llm and not holding:
         raise HTTPException(status_code=400, detail="No model loaded.")
     
-    current_model = model_manager.current_model_name
+    # Held requests will be served by the incoming model, so look up ITS cache entries
+    current_model = model_manager.swap_status["to_model"] if holding else model_manager.current_model_name
 
-    # --- 3. Cache Check (Semantic Search) ---
-    # Uncomment when ready to use caching
-    """
-    cached_entry = await find_cached_response(db, request.prompt, current_model)
-    if cached_entry:
+    # --- 3a. Exact-Match Cache (shared memory, all workers) ---
+    exact_key = response_key(current_model, request.prompt, request.max_tokens)
+    exact_hit = response_cache.get(exact_key)
+    if exact_hit is not None:
+        background_tasks.add_task(
+            trace_recorder.record, current_model, request.prompt, request.max_tokens, "exact", len(exact_hit)
+        )
         return {
-            "response": cached_entry.response_text, 
+            "response": exact_hit.decode("utf-8"),
             "model_used": current_model,
-            "source": "cache ⚡" 
+            "source": "cache ⚡"
         }
-    """
 
-    # --- 4. Inference ---
+    # --- 3b. Semantic Cache Lookup (runs in parallel with queueing) ---
+    # Started now, checked while we wait for the GPU: a miss costs no extra latency.
+    lookup = asyncio.create_task(semantic_lookup(request.prompt, current_model))
+
+    # --- 4. Token Pre-Validation ---
+    # Tokenize off the event loop, BEFORE queuing for the GPU, so oversized
+    # prompts fail fast instead of waiting on gpu_lock and then failing in vLLM.
+    # (Skipped while held for a swap: the incoming model's tokenizer isn't loaded yet.)
+    loop = asyncio.get_event_loop()
+    prepared = None
+    if not holding:
+        try:
+            prepared = await loop.run_in_executor(
+                None,
+                model_manager.prepare,
+                request.prompt,
+                request.max_tokens
+            )
+        except PromptTooLongError as e:
+            await stop_lookup(lookup)
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            await stop_lookup(lookup)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    # --- 5. Queue for the GPU, racing the cache lookup ---
+    deadline = loop.time() + SWAP_HOLD_DEADLINE if holding else None
+    def time_left():
+        return None if deadline is None else max(0.0, deadline - loop.time())
+
+    acquire = asyncio.ensure_future(gpu_lock.acquire())
+    if holding:
+        held_requests["count"] += 1
     try:
-        async with gpu_lock:
-            loop = asyncio.get_event_loop()
-            generated_text = await loop.run_in_executor(
+        await asyncio.wait({lookup, acquire}, timeout=time_left(), return_when=asyncio.FIRST_COMPLETED)
+
+        if acquire.done():
+            # Reached the GPU first. The lookup is ~ms vs seconds of generation, so give it a short grace.
+            if not lookup.done():
+                await asyncio.wait({lookup}, timeout=CACHE_LOOKUP_GRACE)
+            cached_text = lookup_result(lookup)
+            if cached_text is not None:
+                gpu_lock.release()
+                pipeline_stats["hits_at_gpu"] += 1
+        else:
+            cached_text = lookup_result(lookup)
+            if cached_text is not None:
+                # Hit while still queued: give up our place in line
+                leave_gpu_queue(acquire)
+                pipeline_stats["hits_while_queued"] += 1
+            else:
+                await asyncio.wait({acquire}, timeout=time_left())
+                if not acquire.done():
+                    leave_gpu_queue(acquire)
+                    await stop_lookup(lookup)
+                    raise HTTPException(status_code=503, detail="Model swap in progress. Try again shortly.")
+    except asyncio.CancelledError:
+        leave_gpu_queue(acquire)
+        await stop_lookup(lookup)
+        raise
+    finally:
+        if holding:
+            held_requests["count"] -= 1
+
+    if cached_text is not None:
+        cached_bytes = cached_text.encode("utf-8")
+        response_cache.put(exact_key, cached_bytes)
+        background_tasks.add_task(
+            trace_recorder.record, current_model, request.prompt, request.max_tokens, "semantic", len(cached_bytes)
+        )
+        return {
+            "response": cached_text,
+            "model_used": current_model,
+            "source": "cache ⚡"
+        }
+
+    # --- 6. Inference (we hold gpu_lock here) ---
+    lookup.cancel() # Awaited after generation, so cleanup never delays the GPU
+    pipeline_stats["misses"] += 1
+    try:
+        try:
+            # A swap may have cut over while we were queued: label, cache and tokenize for the model that runs
+            if not model_manager.llm:
+                raise HTTPException(status_code=503, detail=f"No model loaded: {model_manager.swap_status['error']}")
+            current_model = model_manager.current_model_name
+            exact_key = response_key(current_model, request.prompt, request.max_tokens)
+            if prepared is None or prepared.model_id != current_model:
+                prepared = await loop.run_in_executor(
+                    None,
+                    model_manager.prepare,
+                    request.prompt,
+                    request.max_tokens
+                )
+
+            gpu_start = time.perf_counter()
+            generated_text, completion_tokens = await loop.run_in_executor(
                 None, 
-                model_manager.generate, 
-                request.prompt, 
-                request.max_tokens
+                model_manager.generate_prepared, 
+                prepared
             )
+            gpu_seconds = time.perf_counter() - gpu_start
+        finally:
+            gpu_lock.release()
+            await stop_lookup(lookup)
         
-        # 5. Save to Cache
+        # 7. Save to Cache
+        generated_bytes = generated_text.encode("utf-8")
+        response_cache.put(exact_key, generated_bytes)
         background_tasks.add_task(
             save_to_cache_task, 
             request.prompt, 
             generated_text, 
             current_model
         )
+        background_tasks.add_task(
+            trace_recorder.record, current_model, request.prompt, request.max_tokens, "gpu",
+            len(generated_bytes), completion_tokens, gpu_seconds
+        )
 
         return {
             "response": generated_text, 
             "model_used": current_model,
-            "source": "gpu 🐢"
+            "source": "gpu 🐢",
+            "usage": {
+                "prompt_tokens": len(prepared.token_ids),
+                "completion_tokens": completion_tokens,
+                "max_tokens": prepared.max_tokens,
+                "truncated": prepared.truncated
+            }
         }
+    except HTTPException:
+        raise
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,7 +1,18 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, LargeBinary
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from pgvector.sqlalchemy import Vector
 from app.database import Base
+from app.services.response_store import response_store
+
+class CachedResponse(Base):
+    __tablename__ = "cached_responses"
+
+    # SHA-256 of the raw response text: identical answers are stored once
+    content_hash = Column(LargeBinary(32), primary_key=True)
+    body = Column(LargeBinary, nullable=False) # zstd frame (optionally dictionary-compressed)
+    raw_size = Column(Integer, nullable=False) # Uncompressed size in bytes, for stats
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 class SemanticCache(Base):
     __tablename__ = "semantic_cache"
@@ -10,10 +21,17 @@ class SemanticCache(Base):
     prompt_text = Column(Text, nullable=False)
     # 384 dimensions matches our all-MiniLM-L6-v2 model
     prompt_vector = Column(Vector(384), nullable=False) 
-    response_text = Column(Text, nullable=False)
+    response_hash = Column(LargeBinary(32), ForeignKey("cached_responses.content_hash"), nullable=False, index=True)
     model_tag = Column(String, nullable=False) # e.g., 'Qwen-32B'
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Joined so a cache hit is still a single query
+    response = relationship(CachedResponse, lazy="joined")
+
+    @property
+    def response_text(self) -> str:
+        return response_store.decompress(self.response.body)
+
     # We will verify the index creation in the init script
 
 class APIKey(Base):
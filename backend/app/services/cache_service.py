@@ -1,13 +1,30 @@
+from sqlalchemy import func
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.models import SemanticCache
+from sqlalchemy.dialects.postgresql import insert
+from app.models import SemanticCache, CachedResponse
 from app.services.embedding_service import embedding_service
+from app.services.response_store import response_store
+from app.services.log_service import logger
 from app.database import AsyncSessionLocal # Needed for background tasks
 import asyncio
+import os
 
 # Threshold: Lower means stricter matching. 
-# 0.2 is a good baseline for MiniLM-L6-v2.
-SIMILARITY_THRESHOLD = 0.2
+# 0.2 is a good baseline for MiniLM-L6-v2. Tune with replay_trace.py.
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.2"))
+
+# Writes closer than this to an existing row (same model) are redundant:
+# they would always be served by that row, so we don't insert them.
+# Must stay well below SIMILARITY_THRESHOLD, or prompts that miss would never get cached.
+DUPLICATE_EPSILON = min(0.05, SIMILARITY_THRESHOLD / 4)
+
+# Write-path counters, exposed via /admin/stats
+cache_write_stats = {
+    "inserted": 0,
+    "skipped_near_duplicate": 0,
+    "bytes_saved": 0, # prompt + vector bytes not written
+}
 
 async def get_embedding_safe(prompt: str):
     """
@@ -44,19 +61,48 @@ async def save_to_cache_task(prompt: str, response: str, model: str):
     """
     BACKGROUND TASK: Saves interaction to DB.
     Self-contained: Opens its own DB session.
+    Skips the insert if a near-identical prompt is already cached for this model.
     """
-    # 1. Generate Vector (CPU intensive, good to do in background)
-    vector = embedding_service.embed_text(prompt)
+    # 1. Generate Vector (CPU intensive / IPC: keep it off the event loop)
+    vector = await get_embedding_safe(prompt)
     
-    # 2. Save to DB using a fresh session
+    # 2. Check + save in one transaction using a fresh session
     async with AsyncSessionLocal() as db:
+        # Serialize writers per model so concurrent misses on the same prompt
+        # can't both pass the neighbour check. Released on commit/rollback.
+        await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(model))))
+
+        distance_col = SemanticCache.prompt_vector.cosine_distance(vector)
+        result = await db.execute(
+            select(distance_col)
+            .filter(SemanticCache.model_tag == model)
+            .order_by(distance_col) # ORDER BY + LIMIT lets pgvector use the ANN index
+            .limit(1)
+        )
+        nearest = result.scalars().first()
+        if nearest is not None and nearest < DUPLICATE_EPSILON:
+            await db.rollback()
+            cache_write_stats["skipped_near_duplicate"] += 1
+            cache_write_stats["bytes_saved"] += len(prompt.encode("utf-8")) + len(vector) * 4
+            logger.info("cache_skipped_duplicate", model=model, distance=round(nearest, 4), body={"prompt": prompt})
+            return
+
+        # 3. Compress + hash the body (content-addressed: paraphrases share one row)
+        content_hash = response_store.content_hash(response)
+        body = response_store.compress(response)
+        await db.execute(
+            insert(CachedResponse)
+            .values(content_hash=content_hash, body=body, raw_size=len(response.encode("utf-8")))
+            .on_conflict_do_nothing(index_elements=[CachedResponse.content_hash])
+        )
         new_entry = SemanticCache(
             prompt_text=prompt,
             prompt_vector=vector,
-            response_text=response,
+            response_hash=content_hash,
             model_tag=model
         )
         db.add(new_entry)
         await db.commit()
-    
-    print(f"💾 [Cache] Saved new response for: '{prompt[:20]}...'")
\ No newline at end of file
+
+    cache_write_stats["inserted"] += 1
+    logger.info("cache_saved", model=model, body={"prompt": prompt})
\ No newline at end of file
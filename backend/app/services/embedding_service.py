@@ -1,5 +1,19 @@
 from sentence_transformers import SentenceTransformer
+from multiprocessing.connection import Client
+from multiprocessing import AuthenticationError
+import numpy as np
+import os
+import threading
 import time
+from app.services.shm_cache import embedding_cache
+from app.services.log_service import logger
+
+# Optional: Unix socket of a shared embedding_server.py process.
+# When set, workers don't load MiniLM themselves.
+EMBEDDING_SOCKET = os.getenv("EMBEDDING_SOCKET")
+EMBEDDING_AUTHKEY = os.getenv("EMBEDDING_AUTHKEY", "").encode() or None
+# Seconds to wait for the server before falling back to the local model
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "2.0"))
 
 class EmbeddingService:
     _instance = None
@@ -8,6 +22,7 @@ class EmbeddingService:
         if cls._instance is None:
             cls._instance = super(EmbeddingService, cls).__new__(cls)
             cls._instance.model = None
+            cls._instance.local = threading.local() # One IPC connection per executor thread
         return cls._instance
 
     def initialize(self):
@@ -21,16 +36,52 @@ class EmbeddingService:
         self.model = SentenceTransformer('all-MiniLM-L6-v2', device='cpu')
         print(f"✅ Embedding Model loaded in {time.time() - start:.2f}s")
 
+    def _embed_remote(self, text: str):
+        """
+        Asks the shared embedding process. Returns None if it is unreachable,
+        slow (EMBEDDING_TIMEOUT) or reports an error.
+        """
+        conn = getattr(self.local, "conn", None)
+        try:
+            if conn is None:
+                conn = Client(EMBEDDING_SOCKET, family="AF_UNIX", authkey=EMBEDDING_AUTHKEY)
+                self.local.conn = conn
+            conn.send_bytes(text.encode("utf-8"))
+            if not conn.poll(EMBEDDING_TIMEOUT):
+                raise TimeoutError(f"no reply within {EMBEDDING_TIMEOUT}s")
+            payload = conn.recv_bytes()
+            if not payload:
+                # Server-side encode failed; the connection itself is still in sync
+                logger.warning("embedding_server_error", socket=EMBEDDING_SOCKET)
+                return None
+            return np.frombuffer(payload, dtype=np.float32)
+        except (OSError, EOFError, AuthenticationError) as e:
+            logger.warning("embedding_server_unavailable", error=str(e), socket=EMBEDDING_SOCKET)
+            # Drop the connection: a late reply would otherwise be read as the next answer
+            if conn is not None:
+                conn.close()
+            self.local.conn = None
+            return None
+
     def embed_text(self, text: str):
         """
         Converts text -> Vector[384]
+        Memoized in shared memory, so every worker benefits from any worker's work.
         """
-        if not self.model:
-            self.initialize()
-        
-        # encode returns a numpy array, we convert to list for database storage
-        embedding = self.model.encode(text)
+        key = text.encode("utf-8")
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            return np.frombuffer(cached, dtype=np.float32).tolist()
+
+        embedding = self._embed_remote(text) if EMBEDDING_SOCKET else None
+        if embedding is None:
+            if not self.model:
+                self.initialize()
+            # encode returns a numpy array, we convert to list for database storage
+            embedding = self.model.encode(text)
+
+        embedding_cache.put(key, embedding.astype(np.float32).tobytes())
         return embedding.tolist()
 
 # Global instance
-embedding_service = EmbeddingService()
\ No newline at end of file
+embedding_service = EmbeddingService()
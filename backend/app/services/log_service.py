@@ -0,0 +1,125 @@
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# --- Structured Logging ---
+# log() only builds a dict and enqueues it; a background thread serializes
+# batches to JSON lines. When the queue is full, records are dropped (and counted)
+# instead of blocking the request.
+LOG_PATH = os.getenv("LOG_PATH") # Default: stdout
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = 512
+
+# Per-level sampling, e.g. LOG_SAMPLE_RATES="debug=0.01,info=1"
+LOG_SAMPLE_RATES = {"debug": 0.0, "info": 1.0, "warning": 1.0, "error": 1.0}
+LOG_SAMPLE_RATES.update({
+    level: float(rate)
+    for level, rate in (
+        item.split("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if item
+    )
+})
+
+# Fraction of logged records that also carry their full bodies (e.g. prompts)
+LOG_BODY_SAMPLE_RATE = float(os.getenv("LOG_BODY_SAMPLE_RATE", "0.01"))
+
+class StructuredLogger:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(StructuredLogger, cls).__new__(cls)
+            cls._instance.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+            cls._instance.writer = None
+            cls._instance.start_lock = threading.Lock()
+            cls._instance.stats = {"enqueued": 0, "written": 0, "dropped": 0, "sampled_out": 0, "write_errors": 0}
+        return cls._instance
+
+    def _start(self):
+        with self.start_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+                self.writer.start()
+
+    def _write_loop(self):
+        stream = sys.stdout
+        if LOG_PATH:
+            try:
+                stream = open(LOG_PATH, "a", encoding="utf-8")
+            except OSError as e:
+                print(f"⚠️ Cannot open LOG_PATH '{LOG_PATH}', logging to stdout: {e}")
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            records = [r for r in batch if r is not None]
+            if records:
+                try:
+                    stream.write("".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records))
+                    stream.flush()
+                    self.stats["written"] += len(records)
+                except Exception:
+                    # Full disk, closed pipe, unserializable field: lose this batch, keep the writer alive
+                    self.stats["write_errors"] += 1
+                    self.stats["dropped"] += len(records)
+            if stop:
+                return
+
+    def log(self, level: str, event: str, body: dict = None, **fields):
+        """
+        Enqueues one JSON record. 'body' holds large fields (prompts, responses):
+        they are attached only for a LOG_BODY_SAMPLE_RATE fraction of records,
+        otherwise replaced by their lengths.
+        """
+        rate = LOG_SAMPLE_RATES.get(level, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.stats["sampled_out"] += 1
+            return
+
+        record = {"ts": round(time.time(), 6), "level": level, "event": event, "pid": os.getpid(), **fields}
+        if body:
+            if random.random() < LOG_BODY_SAMPLE_RATE:
+                record.update(body)
+            else:
+                record.update({f"{key}_chars": len(value) for key, value in body.items()})
+
+        if self.writer is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+            self.stats["enqueued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def debug(self, event: str, **fields):
+        self.log("debug", event, **fields)
+
+    def info(self, event: str, **fields):
+        self.log("info", event, **fields)
+
+    def warning(self, event: str, **fields):
+        self.log("warning", event, **fields)
+
+    def error(self, event: str, **fields):
+        self.log("error", event, **fields)
+
+    def flush(self, timeout: float = 2.0):
+        """Drains the queue on shutdown."""
+        if self.writer is None or not self.writer.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.writer.join(timeout)
+
+# Global instance
+logger = StructuredLogger()
@@ -1,9 +1,46 @@
 import gc
+import glob
+import os
+import time
 import torch
 from vllm import LLM, SamplingParams
+from vllm.inputs import TokensPrompt
 # specialized cleanup for vLLM's backend
 from vllm.distributed.parallel_state import destroy_model_parallel 
-from typing import Optional
+from typing import Optional, List, NamedTuple
+from app.services.log_service import logger
+
+MAX_MODEL_LEN = 8192
+# Lowered util slightly to 0.85 to leave room for your OS + Embedding Model
+GPU_MEMORY_UTILIZATION = 0.85
+# Preloading: the second engine gets the VRAM actually free, minus this fraction of the total,
+# and is only built if that leaves at least MIN_PRELOAD_KV_CACHE_GB for its KV cache.
+PRELOAD_MEMORY_MARGIN = 0.05
+MIN_PRELOAD_KV_CACHE_GB = float(os.getenv("MIN_PRELOAD_KV_CACHE_GB", "1.0"))
+# What to do with prompts that don't fit: 'reject' (HTTP 400) or 'truncate' (keep the end of the prompt)
+PROMPT_OVERFLOW_POLICY = os.getenv("PROMPT_OVERFLOW_POLICY", "reject")
+# Always leave room for at least this many generated tokens
+MIN_OUTPUT_TOKENS = 16
+
+# Token accounting, exposed via /admin/stats
+token_stats = {
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "rejected_too_long": 0,
+    "truncated": 0,
+    "max_tokens_clamped": 0,
+}
+
+class PromptTooLongError(ValueError):
+    pass
+
+class PreparedPrompt(NamedTuple):
+    """A prompt already templated + tokenized for a specific model."""
+    model_id: str
+    formatted_prompt: str
+    token_ids: List[int]
+    max_tokens: int
+    truncated: bool
 
 class ModelManager:
     _instance = None
@@ -12,9 +49,27 @@ class ModelManager:
         if cls._instance is None:
             cls._instance = super(ModelManager, cls).__new__(cls)
             cls._instance.llm = None
+            cls._instance.tokenizer = None # Cached per loaded model for pre-validation
             cls._instance.current_model_name = None
+            cls._instance.retired_llm = None # Previous engine after a preloaded cutover, until release()
+            # Progress of the current/last swap, served by /admin/swap-status
+            cls._instance.swap_status = {
+                "phase": "idle", # preloading | draining | unloading | loading | cutover | releasing | done | failed
+                "mode": None,
+                "from_model": None,
+                "to_model": None,
+                "started_at": None,
+                "finished_at": None,
+                "error": None,
+            }
         return cls._instance
 
+    def set_swap_phase(self, phase: str, **fields):
+        self.swap_status.update(phase=phase, **fields)
+        if phase in ("done", "failed"):
+            self.swap_status["finished_at"] = time.time()
+        logger.info("model_swap", **self.swap_status)
+
     def unload_model(self):
         """
         CRITICAL: Forcefully cleans up GPU memory.
@@ -31,6 +86,7 @@ class ModelManager:
             # 2. Delete the object reference
             del self.llm
             self.llm = None
+            self.tokenizer = None
             self.current_model_name = None
             
             # 3. Force Python Garbage Collection
@@ -61,16 +117,8 @@ class ModelManager:
         
         # 2. Initialize vLLM
         try:
-            # Lowered util slightly to 0.85 to leave room for your OS + Embedding Model
-            self.llm = LLM(
-                model=model_path,
-                quantization=quantization, 
-                dtype="auto", # auto is safer than float16 for quantized models
-                gpu_memory_utilization=0.85, 
-                trust_remote_code=True,
-                enforce_eager=True, # Helps with cleanup, slightly slower but safer for swapping
-                max_model_len=8192  # <--- CRITICAL FIX: Limits context window to prevent VRAM OOM on Llama 3.1
-            )
+            self.llm = self._build_llm(model_path, quantization)
+            self.tokenizer = self.llm.get_tokenizer()
             self.current_model_name = model_id
             print(f"✅ {model_id} successfully loaded onto GPU.")
         except Exception as e:
@@ -79,10 +127,88 @@ class ModelManager:
             self.unload_model()
             raise e
 
-    def generate(self, prompt: str, max_tokens=200):
-        if not self.llm:
-            raise RuntimeError("No model loaded. Please load a model first.")
-        
+    def _build_llm(self, model_path: str, quantization: Optional[str], gpu_memory_utilization: float = GPU_MEMORY_UTILIZATION):
+        return LLM(
+            model=model_path,
+            quantization=quantization, 
+            dtype="auto", # auto is safer than float16 for quantized models
+            gpu_memory_utilization=gpu_memory_utilization, 
+            trust_remote_code=True,
+            enforce_eager=True, # Helps with cleanup, slightly slower but safer for swapping
+            max_model_len=MAX_MODEL_LEN  # <--- CRITICAL FIX: Limits context window to prevent VRAM OOM on Llama 3.1
+        )
+
+    # --- NON-DISRUPTIVE SWAPS ---
+    # preload() builds the new engine next to the old one (old keeps serving),
+    # activate() flips the references (call while holding the GPU lock),
+    # release() frees the old engine afterwards.
+
+    def preload_memory_utilization(self, model_path: str) -> Optional[float]:
+        """
+        gpu_memory_utilization for a second engine next to the current one, sized
+        from the VRAM actually free (vLLM treats it as this engine's share of *total*
+        memory). None if weights + MIN_PRELOAD_KV_CACHE_GB don't fit, or if the weight
+        size is unknown (model_path is not a local directory): swap in drain mode then.
+        """
+        if not torch.cuda.is_available():
+            return None
+        weight_files = [
+            f for pattern in ("*.safetensors", "*.bin")
+            for f in glob.glob(os.path.join(model_path, pattern))
+        ]
+        if not weight_files:
+            print(f"⚠️ Can't size {model_path} for preloading (no local weights), using drain mode.")
+            return None
+
+        free, total = torch.cuda.mem_get_info()
+        utilization = free / total - PRELOAD_MEMORY_MARGIN
+        needed = sum(os.path.getsize(f) for f in weight_files) + MIN_PRELOAD_KV_CACHE_GB * 1024**3
+        if utilization * total < needed:
+            print(f"⚠️ Not enough free VRAM to preload ({free / 1024**3:.1f} GB free, "
+                  f"{needed / 1024**3:.1f} GB needed), using drain mode.")
+            return None
+        return min(utilization, GPU_MEMORY_UTILIZATION)
+
+    def preload(self, model_path: str, model_id: str, quantization: Optional[str] = "awq",
+                gpu_memory_utilization: float = GPU_MEMORY_UTILIZATION):
+        """
+        Loads a model WITHOUT touching the one currently serving.
+        Pass the share from preload_memory_utilization(); the engine keeps that
+        (smaller) KV cache until the next swap.
+        Returns (llm, tokenizer) to hand to activate().
+        """
+        print(f"🚀 Preloading model: {model_id} from {model_path} "
+              f"(gpu_memory_utilization={gpu_memory_utilization:.2f}, current model keeps serving)...")
+        llm = self._build_llm(model_path, quantization, gpu_memory_utilization)
+        print(f"✅ {model_id} preloaded.")
+        return llm, llm.get_tokenizer()
+
+    def activate(self, model_id: str, llm, tokenizer):
+        """
+        Atomic cutover to a preloaded engine. The old one is kept in retired_llm.
+        """
+        self.retired_llm = self.llm
+        self.llm, self.tokenizer, self.current_model_name = llm, tokenizer, model_id
+
+    def release_retired(self):
+        """
+        Frees the engine replaced by activate(). Unlike unload_model(), this keeps
+        the model-parallel state, which the active engine still uses.
+        """
+        self.retired_llm = None
+        self.free_gpu_memory()
+        print("✅ Previous model released.")
+
+    def free_gpu_memory(self):
+        """
+        Collects unreferenced engines (e.g. a preload that failed half-way) and returns their VRAM.
+        """
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+
+    def format_prompt(self, prompt: str) -> str:
         model_id = self.current_model_name.lower()
         formatted_prompt = prompt # Default fallback
 
@@ -111,7 +237,7 @@ class ModelManager:
         # 3. QWEN / GEMMA / OTHERS (Use Auto-Tokenizer)
         else:
             try:
-                tokenizer = self.llm.get_tokenizer()
+                tokenizer = self.tokenizer
                 messages = [
                     {"role": "system", "content": "You are a helpful AI assistant."}, # <--- Hidden System Prompt
                     {"role": "user", "content": prompt}
@@ -122,16 +248,88 @@ class ModelManager:
                     add_generation_prompt=True
                 )
             except Exception as e:
-                print(f"⚠️ Template Error: {e}")
+                logger.warning("template_error", model=self.current_model_name, error=str(e))
                 # Ultimate Fallback
                 formatted_prompt = f"System: You are a helpful assistant.\nUser: {prompt}\nAssistant:"
 
-        print(f"📝 PROMPT SENT TO GPU ({model_id}):\n{formatted_prompt}") # Check your logs to see this!
+        return formatted_prompt
+
+    def prepare(self, prompt: str, max_tokens: int = 200) -> PreparedPrompt:
+        """
+        Templates + tokenizes the prompt (CPU only, safe to run without the GPU lock).
+        Rejects or truncates prompts that can't fit, and clamps max_tokens to what's left.
+        """
+        if not self.tokenizer:
+            raise RuntimeError("No model loaded. Please load a model first.")
+
+        model_id = self.current_model_name
+        tokenizer = self.tokenizer
+        limit = MAX_MODEL_LEN - MIN_OUTPUT_TOKENS
+
+        formatted_prompt = self.format_prompt(prompt)
+        # Same call vLLM makes on a text prompt, so the ids can be handed over as-is
+        token_ids = tokenizer.encode(formatted_prompt)
+        truncated = False
+
+        if len(token_ids) > limit:
+            if PROMPT_OVERFLOW_POLICY != "truncate":
+                token_stats["rejected_too_long"] += 1
+                raise PromptTooLongError(
+                    f"Prompt is {len(token_ids)} tokens; {model_id} allows {limit} "
+                    f"(max_model_len={MAX_MODEL_LEN}, min output {MIN_OUTPUT_TOKENS})."
+                )
+
+            # Drop tokens from the start of the user prompt (the question is usually at the end).
+            # Re-encoding after decode can shift by a token, so repeat until it fits.
+            prompt_ids = tokenizer.encode(prompt, add_special_tokens=False)
+            while len(token_ids) > limit:
+                keep = len(prompt_ids) - (len(token_ids) - limit)
+                if keep <= 0:
+                    token_stats["rejected_too_long"] += 1
+                    raise PromptTooLongError("Prompt template alone exceeds the context window.")
+                prompt_ids = prompt_ids[-keep:]
+                formatted_prompt = self.format_prompt(tokenizer.decode(prompt_ids))
+                token_ids = tokenizer.encode(formatted_prompt)
+            truncated = True
+            token_stats["truncated"] += 1
+
+        remaining = MAX_MODEL_LEN - len(token_ids)
+        if max_tokens > remaining:
+            token_stats["max_tokens_clamped"] += 1
+            max_tokens = remaining
+
+        return PreparedPrompt(model_id, formatted_prompt, token_ids, max_tokens, truncated)
+
+    def generate_prepared(self, prepared: PreparedPrompt):
+        """
+        Runs a prepared prompt on the GPU. Returns (text, completion_tokens).
+        """
+        if not self.llm:
+            raise RuntimeError("No model loaded. Please load a model first.")
+        if prepared.model_id != self.current_model_name:
+            raise RuntimeError(f"Prompt was prepared for {prepared.model_id}, but {self.current_model_name} is loaded.")
+
+        # Full prompt only on sampled records (LOG_BODY_SAMPLE_RATE), never a blocking write
+        logger.info(
+            "prompt_sent",
+            model=prepared.model_id,
+            prompt_tokens=len(prepared.token_ids),
+            max_tokens=prepared.max_tokens,
+            body={"prompt": prepared.formatted_prompt}
+        )
 
         # --- GENERATE ---
-        params = SamplingParams(temperature=0.7, max_tokens=max_tokens)
-        outputs = self.llm.generate([formatted_prompt], params)
-        return outputs[0].outputs[0].text
+        # Pass token ids so vLLM doesn't tokenize the prompt a second time
+        params = SamplingParams(temperature=0.7, max_tokens=prepared.max_tokens)
+        outputs = self.llm.generate([TokensPrompt(prompt_token_ids=prepared.token_ids)], params)
+        completion = outputs[0].outputs[0]
+
+        token_stats["prompt_tokens"] += len(prepared.token_ids)
+        token_stats["completion_tokens"] += len(completion.token_ids)
+        return completion.text, len(completion.token_ids)
+
+    def generate(self, prompt: str, max_tokens=200):
+        return self.generate_prepared(self.prepare(prompt, max_tokens))[0]
 
 # Global instance
 model_manager = ModelManager()
\ No newline at end of file
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import zstandard as zstd
+
+# Trained dictionaries live on disk as '<dict_id>.zdict' (see train_response_dict.py).
+# The newest one is used for new writes; older ones are kept so existing rows
+# can still be decoded (the dict_id is stored in every zstd frame header).
+ZSTD_DICT_DIR = os.getenv("ZSTD_DICT_DIR", "zstd_dicts")
+ZSTD_LEVEL = 9
+
+
+class ResponseStore:
+    """
+    Content-addressed, compressed storage for cached completions.
+    Identical answers share one row in 'cached_responses', keyed by SHA-256.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ResponseStore, cls).__new__(cls)
+            cls._instance.compressor = None
+            cls._instance.decompressors = {}
+        return cls._instance
+
+    def _load_dict(self, dict_id: int):
+        path = os.path.join(ZSTD_DICT_DIR, f"{dict_id}.zdict")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return zstd.ZstdCompressionDict(f.read())
+
+    def _latest_dict(self):
+        if not os.path.isdir(ZSTD_DICT_DIR):
+            return None
+        paths = [
+            os.path.join(ZSTD_DICT_DIR, name)
+            for name in os.listdir(ZSTD_DICT_DIR)
+            if name.endswith(".zdict")
+        ]
+        if not paths:
+            return None
+        with open(max(paths, key=os.path.getmtime), "rb") as f:
+            return zstd.ZstdCompressionDict(f.read())
+
+    def initialize(self):
+        """
+        Builds the compressor around the newest trained dictionary (if any).
+        """
+        dictionary = self._latest_dict()
+        if dictionary is not None:
+            self.compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+            self.decompressors[dictionary.dict_id()] = zstd.ZstdDecompressor(dict_data=dictionary)
+        else:
+            self.compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL)
+        self.decompressors.setdefault(0, zstd.ZstdDecompressor())
+
+    def content_hash(self, text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def compress(self, text: str) -> bytes:
+        if not self.compressor:
+            self.initialize()
+        return self.compressor.compress(text.encode("utf-8"))
+
+    def decompress(self, body: bytes) -> str:
+        if not self.compressor:
+            self.initialize()
+
+        dict_id = zstd.get_frame_parameters(body).dict_id
+        decompressor = self.decompressors.get(dict_id)
+        if decompressor is None:
+            dictionary = self._load_dict(dict_id)
+            if dictionary is None:
+                raise RuntimeError(f"Missing zstd dictionary {dict_id} in {ZSTD_DICT_DIR}")
+            decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+            self.decompressors[dict_id] = decompressor
+
+        return decompressor.decompress(body).decode("utf-8")
+
+# Global instance
+response_store = ResponseStore()
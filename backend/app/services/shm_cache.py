@@ -0,0 +1,251 @@
+import fcntl
+import hashlib
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+# --- Shared-memory caches ---
+# Fixed-slot hash tables living in /dev/shm, shared by every uvicorn worker on the host.
+# Reads are lock-free (seqlock: retry/miss if a writer touched the slot mid-read);
+# writes take one of N striped locks (threading.Lock in-process + fcntl byte-range lock across processes).
+
+SHM_PREFIX = os.getenv("SHM_PREFIX", "aingine")
+SHM_CACHE_ENABLED = os.getenv("SHM_CACHE_ENABLED", "1") == "1"
+# Wipe both tables when a worker starts (e.g. after a prompt template change).
+# Otherwise entries survive restarts for as long as /dev/shm does; see also POST /admin/shm-cache/clear.
+SHM_CACHE_RESET = os.getenv("SHM_CACHE_RESET", "0") == "1"
+# After a failed attach, the table is skipped (= miss) for this many seconds
+ATTACH_RETRY_SECONDS = 5.0
+
+# Segment header: magic, layout version, slot size, bucket count.
+# Checked on attach; a segment with another layout is replaced, never reinterpreted.
+SEGMENT_HEADER = struct.Struct("<8sIII")
+SEGMENT_MAGIC = b"AINGSHM\0"
+SEGMENT_VERSION = 2
+SLOTS_OFFSET = 64 # Slots start on their own cache line
+
+# Slot header: seq (odd = being written), write stamp, value length, used flag, key digest.
+# 'used' (not length) marks occupied slots, so an empty value is still a valid hit.
+# Zero-filled memory = all slots unused.
+SLOT_HEADER = struct.Struct("<QIIB16s")
+USED_OFFSET = 16 # Byte offset of 'used' in the slot header
+BUCKET_SLOTS = 4 # Probe window; the oldest slot in the bucket is evicted on insert
+STRIPES = 64
+ATTACH_LOCK = STRIPES # fcntl byte serializing create/attach across workers
+
+
+def _create_segment(name: str, size: int, header: bytes):
+    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    shm.buf[:len(header)] = header
+    return shm
+
+
+def _open_segment(name: str, size: int, header: bytes):
+    """
+    Creates the segment, or attaches to it if another worker got there first.
+    Callers hold ATTACH_LOCK, so a live worker never sees a segment that is
+    not yet sized and stamped.
+    """
+    try:
+        shm = _create_segment(name, size, header)
+    except FileExistsError:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except ValueError:
+            # Zero-sized: its creator died between shm_open and ftruncate
+            shm = None
+        if shm is None or shm.size < size or bytes(shm.buf[:len(header)]) != header:
+            if shm is not None:
+                shm.close()
+            print(f"♻️ Replacing shared segment '{name}' (missing header or layout changed)")
+            os.unlink(f"/dev/shm/{name}")
+            shm = _create_segment(name, size, header)
+
+    # The segment must outlive any single worker. Stop the resource tracker
+    # from unlinking it when this process exits.
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+class SharedSlotTable:
+    """
+    Bytes -> bytes cache in a shared-memory segment.
+    Values larger than 'value_size' are simply not cached.
+    If the segment cannot be attached, every call is a miss / no-op.
+    """
+
+    def __init__(self, name: str, slots: int, value_size: int):
+        self.name = f"{SHM_PREFIX}-{name}"
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        self.value_size = value_size
+        # 8-byte aligned so the seq counter never straddles a cache line boundary
+        self.slot_size = (SLOT_HEADER.size + value_size + 7) & ~7
+        self.shm = None
+        self.lock_fd = None
+        self.retry_at = 0.0
+        self.init_lock = threading.Lock()
+        self.thread_locks = [threading.Lock() for _ in range(STRIPES)]
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "oversize": 0, "attach_errors": 0, "clears": 0}
+
+    def initialize(self) -> bool:
+        """Attaches once per process. Returns False if the table is unusable right now."""
+        if not SHM_CACHE_ENABLED:
+            return False
+        with self.init_lock:
+            if self.shm:
+                return True
+            if time.time() < self.retry_at:
+                return False
+            try:
+                self._attach()
+            except Exception as e:
+                self.stats["attach_errors"] += 1
+                self.retry_at = time.time() + ATTACH_RETRY_SECONDS
+                print(f"⚠️ Shared cache '{self.name}' unavailable, retrying in {ATTACH_RETRY_SECONDS:.0f}s: {e}")
+                return False
+        if SHM_CACHE_RESET:
+            self.clear()
+        return True
+
+    def _attach(self):
+        size = SLOTS_OFFSET + self.buckets * BUCKET_SLOTS * self.slot_size
+        header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.slot_size, self.buckets)
+        lock_fd = os.open(f"/dev/shm/{self.name}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX, 1, ATTACH_LOCK)
+            try:
+                shm = _open_segment(self.name, size, header)
+            finally:
+                fcntl.lockf(lock_fd, fcntl.LOCK_UN, 1, ATTACH_LOCK)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        self.lock_fd = lock_fd
+        self.shm = shm
+        print(f"🧩 Shared cache '{self.name}' attached ({size / 1024**2:.0f} MB)")
+
+    def _slot_offset(self, index: int) -> int:
+        return SLOTS_OFFSET + index * self.slot_size
+
+    def clear(self):
+        """
+        Marks every slot unused, for all workers at once (the segment stays mapped).
+        Takes every stripe lock, so it never interleaves with a put().
+        """
+        if not self.shm and not self.initialize():
+            return
+        buf = self.shm.buf
+        for lock in self.thread_locks:
+            lock.acquire()
+        try:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX, STRIPES, 0)
+            try:
+                for i in range(self.buckets * BUCKET_SLOTS):
+                    buf[self._slot_offset(i) + USED_OFFSET] = 0
+            finally:
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, STRIPES, 0)
+        finally:
+            for lock in self.thread_locks:
+                lock.release()
+        self.stats["clears"] += 1
+        print(f"🧹 Shared cache '{self.name}' cleared")
+
+    def _digest(self, key: bytes) -> bytes:
+        return hashlib.blake2b(key, digest_size=16).digest()
+
+    def _bucket(self, digest: bytes) -> int:
+        return int.from_bytes(digest[:8], "little") % self.buckets
+
+    def get(self, key: bytes):
+        if not SHM_CACHE_ENABLED:
+            return None
+        if not self.shm and not self.initialize():
+            self.stats["misses"] += 1
+            return None
+
+        digest = self._digest(key)
+        buf = self.shm.buf
+        base = self._bucket(digest) * BUCKET_SLOTS
+
+        for i in range(BUCKET_SLOTS):
+            offset = self._slot_offset(base + i)
+            seq, _, length, used, slot_digest = SLOT_HEADER.unpack_from(buf, offset)
+            if seq & 1 or not used or slot_digest != digest:
+                continue
+
+            start = offset + SLOT_HEADER.size
+            value = bytes(buf[start:start + length])
+
+            # Seqlock check: slot was rewritten while we copied it
+            if SLOT_HEADER.unpack_from(buf, offset)[0] != seq:
+                break
+            self.stats["hits"] += 1
+            return value
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: bytes, value: bytes):
+        if not SHM_CACHE_ENABLED:
+            return
+        if not self.shm and not self.initialize():
+            return
+        if len(value) > self.value_size:
+            self.stats["oversize"] += 1
+            return
+
+        digest = self._digest(key)
+        buf = self.shm.buf
+        bucket = self._bucket(digest)
+        base = bucket * BUCKET_SLOTS
+        stripe = bucket % STRIPES
+
+        with self.thread_locks[stripe]:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                # Same key > empty slot > oldest write
+                target, target_stamp = None, None
+                for i in range(BUCKET_SLOTS):
+                    offset = self._slot_offset(base + i)
+                    _, stamp, _, used, slot_digest = SLOT_HEADER.unpack_from(buf, offset)
+                    if used and slot_digest == digest:
+                        target = offset
+                        break
+                    if not used:
+                        stamp = -1
+                    if target is None or stamp < target_stamp:
+                        target, target_stamp = offset, stamp
+
+                seq = SLOT_HEADER.unpack_from(buf, target)[0]
+                struct.pack_into("<Q", buf, target, seq + 1) # odd: readers skip
+                start = target + SLOT_HEADER.size
+                buf[start:start + len(value)] = value
+                SLOT_HEADER.pack_into(buf, target, seq + 2, int(time.time()) & 0xFFFFFFFF, len(value), 1, digest)
+            finally:
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, 1, stripe)
+
+        self.stats["writes"] += 1
+
+
+# Exact-match responses: key = model + max_tokens + prompt, value = UTF-8 text
+response_cache = SharedSlotTable(
+    "responses",
+    slots=int(os.getenv("SHM_RESPONSE_SLOTS", "4096")),
+    value_size=16 * 1024,
+)
+
+# Embedding memo: key = text, value = 384 x float32
+embedding_cache = SharedSlotTable(
+    "embeddings",
+    slots=int(os.getenv("SHM_EMBEDDING_SLOTS", "32768")),
+    value_size=384 * 4,
+)
+
+
+def response_key(model: str, prompt: str, max_tokens: int) -> bytes:
+    return f"{model}\0{max_tokens}\0{prompt}".encode("utf-8")
@@ -0,0 +1,63 @@
+import gzip
+import json
+import os
+import threading
+import time
+
+# Set to capture /generate traffic for replay_trace.py, e.g. TRACE_CAPTURE_PATH=traces/generate
+# Each worker writes '<path>.<pid>.jsonl.gz'; records are flushed as gzip members in batches.
+TRACE_CAPTURE_PATH = os.getenv("TRACE_CAPTURE_PATH")
+TRACE_FLUSH_EVERY = 256
+
+class TraceRecorder:
+    """
+    Compact request log: one short-keyed JSON object per /generate call.
+      t: unix time, m: model, p: prompt, k: max_tokens, s: source ('exact' | 'semantic' | 'gpu'),
+      r: response bytes, ct: completion tokens (gpu only), g: GPU seconds (gpu only)
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(TraceRecorder, cls).__new__(cls)
+            cls._instance.buffer = []
+            cls._instance.lock = threading.Lock()
+        return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return bool(TRACE_CAPTURE_PATH)
+
+    def record(self, model: str, prompt: str, max_tokens: int, source: str,
+               response_bytes: int, completion_tokens: int = 0, gpu_seconds: float = 0.0):
+        """Called from a background task; never on the request path."""
+        if not self.enabled:
+            return
+        entry = {"t": round(time.time(), 3), "m": model, "p": prompt, "k": max_tokens, "s": source, "r": response_bytes}
+        if source == "gpu":
+            entry["ct"] = completion_tokens
+            entry["g"] = round(gpu_seconds, 4)
+
+        with self.lock:
+            self.buffer.append(entry)
+            if len(self.buffer) < TRACE_FLUSH_EVERY:
+                return
+            batch, self.buffer = self.buffer, []
+        self._write(batch)
+
+    def flush(self):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        payload = "".join(json.dumps(e, ensure_ascii=False, separators=(",", ":")) + "\n" for e in batch)
+        path = f"{TRACE_CAPTURE_PATH}.{os.getpid()}.jsonl.gz"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Concatenated gzip members are a valid gzip stream, so appending is safe
+        with open(path, "ab") as f:
+            f.write(gzip.compress(payload.encode("utf-8")))
+
+# Global instance
+trace_recorder = TraceRecorder()
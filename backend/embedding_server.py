@@ -0,0 +1,79 @@
+import os
+import queue
+import threading
+import numpy as np
+from multiprocessing.connection import Listener
+from sentence_transformers import SentenceTransformer
+
+# --- Shared Embedding Process ---
+# Run once per host, then start uvicorn with EMBEDDING_SOCKET set to the same path:
+#   python embedding_server.py
+#   EMBEDDING_SOCKET=/tmp/aingine-embed.sock uvicorn app.main:app --workers 4
+# The socket is created 0600 (same user only). Set EMBEDDING_AUTHKEY on both sides to also require a handshake.
+SOCKET_PATH = os.getenv("EMBEDDING_SOCKET", "/tmp/aingine-embed.sock")
+AUTHKEY = os.getenv("EMBEDDING_AUTHKEY", "").encode() or None
+MAX_BATCH = 64
+
+# (text, reply_queue) from every client thread; one encoder thread drains it in batches
+pending = queue.Queue()
+
+def encoder_loop(model):
+    while True:
+        batch = [pending.get()]
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(pending.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            vectors = model.encode([text for text, _ in batch], batch_size=MAX_BATCH)
+            replies = [vector.astype(np.float32).tobytes() for vector in vectors]
+        except Exception as e:
+            # Never let one bad batch kill the encoder: every waiting client gets
+            # an empty reply (= error) and falls back to its local model.
+            print(f"⚠️ Embedding batch failed: {e}")
+            replies = [b""] * len(batch)
+
+        for (_, reply), payload in zip(batch, replies):
+            reply.put(payload)
+
+def serve_client(conn):
+    reply = queue.Queue(maxsize=1)
+    try:
+        while True:
+            # Raw UTF-8 only: never unpickle what a client sends
+            pending.put((conn.recv_bytes().decode("utf-8"), reply))
+            conn.send_bytes(reply.get())
+    except (EOFError, OSError, UnicodeDecodeError):
+        pass
+    finally:
+        conn.close()
+
+def main():
+    print("🧠 Loading Embedding Model (CPU)...")
+    model = SentenceTransformer('all-MiniLM-L6-v2', device='cpu')
+    threading.Thread(target=encoder_loop, args=(model,), daemon=True).start()
+
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+
+    old_umask = os.umask(0o177) # Socket file is created 0600
+    try:
+        listener = Listener(SOCKET_PATH, family="AF_UNIX", authkey=AUTHKEY)
+    finally:
+        os.umask(old_umask)
+    os.chmod(SOCKET_PATH, 0o600)
+
+    with listener:
+        print(f"✅ Embedding server listening on {SOCKET_PATH}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e: # Failed authkey handshake
+                print(f"⚠️ Rejected embedding client: {e}")
+                continue
+            threading.Thread(target=serve_client, args=(conn,), daemon=True).start()
+
+if __name__ == "__main__":
+    main()
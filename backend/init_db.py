@@ -15,6 +15,9 @@ async def init_models():
         # 3. Create tables
         print("🏗️  Creating tables...")
         await conn.run_sync(Base.metadata.create_all)
+
+        # 4. Response bodies are already zstd-compressed; stop TOAST from trying again
+        await conn.execute(text("ALTER TABLE cached_responses ALTER COLUMN body SET STORAGE EXTERNAL"))
         
     print("✅ Database initialized successfully.")
     await engine.dispose()
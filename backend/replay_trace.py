@@ -0,0 +1,220 @@
+import argparse
+import glob
+import gzip
+import heapq
+import itertools
+import json
+import time
+from collections import Counter
+import numpy as np
+from app.services.embedding_service import embedding_service
+
+# --- Offline Cache Replay ---
+# Replays traces captured with TRACE_CAPTURE_PATH through the embedding model and an
+# in-memory semantic cache, for many (threshold, capacity, eviction) settings at once.
+#   python replay_trace.py "traces/generate.*.jsonl.gz" --thresholds 0.05,0.1,0.15,0.2,0.25
+# Per-request cost is proportional to the number of cached entries, so pass --capacities
+# for large traces. With an unlimited capacity, traces are capped at MAX_UNBOUNDED_REQUESTS per model.
+VECTOR_BYTES = 384 * 4
+MAX_UNBOUNDED_REQUESTS = 200000
+
+def load_trace(patterns):
+    records = []
+    for path in itertools.chain.from_iterable(glob.glob(p) for p in patterns):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r["t"])
+    return records
+
+def gpu_cost_estimates(records):
+    """
+    GPU seconds each request would cost on a miss. Measured for requests that
+    hit the GPU in production, estimated from seconds-per-byte for the rest.
+    """
+    measured = [(r["g"], r["r"]) for r in records if r["s"] == "gpu" and r.get("g")]
+    per_byte = sum(g for g, _ in measured) / max(1, sum(b for _, b in measured))
+    return np.array([r["g"] if r["s"] == "gpu" and r.get("g") else r["r"] * per_byte for r in records])
+
+class Config:
+    def __init__(self, threshold, capacity, policy):
+        self.threshold = threshold
+        self.capacity = capacity # entries, 0 = unlimited
+        self.policy = policy # 'lru' or 'fifo'
+        self.heap = [] # (last_used, model, slot, request), lazily invalidated
+        self.count = 0
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.gpu_saved = 0.0
+
+class CandidatePool:
+    """
+    Vectors of one model's requests that are cached in at least one config.
+    Search cost per request is O(pool size), bounded by the configured
+    capacities rather than the trace length. Slots are reused once every
+    config has evicted their entry.
+    """
+
+    def __init__(self, num_configs, dim):
+        self.vectors = np.zeros((1024, dim), dtype=np.float32)
+        self.cached = np.zeros((num_configs, 1024), dtype=bool) # config x slot
+        self.last_used = np.zeros((num_configs, 1024), dtype=np.int64)
+        self.request = np.full(1024, -1, dtype=np.int64) # trace index held by each slot
+        self.length = 0
+        self.free = []
+
+    def _grow(self):
+        size = len(self.request) * 2
+        self.vectors = np.resize(self.vectors, (size, self.vectors.shape[1]))
+        self.cached = np.pad(self.cached, ((0, 0), (0, size - self.cached.shape[1])))
+        self.last_used = np.pad(self.last_used, ((0, 0), (0, size - self.last_used.shape[1])))
+        self.request = np.pad(self.request, (0, size - len(self.request)), constant_values=-1)
+
+    def add(self, i, vector):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.length == len(self.request):
+                self._grow()
+            slot = self.length
+            self.length += 1
+        self.vectors[slot] = vector
+        self.request[slot] = i
+        return slot
+
+    def evict(self, k, slot):
+        self.cached[k, slot] = False
+        if not self.cached[:, slot].any():
+            self.request[slot] = -1
+            self.free.append(slot)
+
+def replay(records, vectors, configs):
+    c = len(configs)
+    thresholds = np.array([cfg.threshold for cfg in configs])
+    min_similarity = 1.0 - thresholds.max()
+
+    models = np.unique([r["m"] for r in records], return_inverse=True)[1]
+    sizes = np.array([len(r["p"].encode("utf-8")) + r["r"] + VECTOR_BYTES for r in records])
+    costs = gpu_cost_estimates(records)
+
+    # Requests only ever match entries of the same model, so each model gets its own pool.
+    # Capacity and eviction order stay global, like the single semantic_cache table.
+    pools = [CandidatePool(c, vectors.shape[1]) for _ in range(models.max() + 1)]
+    all_configs = np.arange(c)
+
+    for i in range(len(records)):
+        model = models[i]
+        pool = pools[model]
+        n = pool.length
+
+        sims = pool.vectors[:n] @ vectors[i]
+        # Only candidates that could hit at the loosest threshold
+        idx = np.nonzero(sims >= min_similarity)[0]
+
+        if idx.size:
+            masked = np.where(pool.cached[:, idx], sims[idx], -np.inf) # (configs, candidates)
+            best = masked.argmax(axis=1)
+            hit = (1.0 - masked[all_configs, best]) < thresholds
+        else:
+            hit = np.zeros(c, dtype=bool)
+
+        for k in np.nonzero(hit)[0]:
+            cfg = configs[k]
+            cfg.hits += 1
+            cfg.gpu_saved += costs[i]
+            if cfg.policy == "lru":
+                slot = idx[best[k]]
+                pool.last_used[k, slot] = i
+                heapq.heappush(cfg.heap, (i, model, slot, pool.request[slot]))
+
+        misses = np.nonzero(~hit)[0]
+        if not misses.size:
+            continue
+
+        slot = pool.add(i, vectors[i])
+        for k in misses:
+            cfg = configs[k]
+            pool.cached[k, slot] = True
+            pool.last_used[k, slot] = i
+            heapq.heappush(cfg.heap, (i, model, slot, i))
+            cfg.count += 1
+            cfg.bytes += sizes[i]
+
+            while cfg.capacity and cfg.count > cfg.capacity:
+                used, m, s, req = heapq.heappop(cfg.heap)
+                victim = pools[m]
+                # Stale heap entries: slot was re-used, or the entry was touched again (LRU)
+                if victim.request[s] == req and victim.cached[k, s] and victim.last_used[k, s] == used:
+                    victim.evict(k, s)
+                    cfg.count -= 1
+                    cfg.bytes -= sizes[req]
+            cfg.peak_bytes = max(cfg.peak_bytes, cfg.bytes)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured /generate traffic against cache settings.")
+    parser.add_argument("traces", nargs="+", help="Trace files or glob patterns (*.jsonl.gz)")
+    parser.add_argument("--thresholds", default="0.05,0.1,0.15,0.2,0.25,0.3")
+    parser.add_argument("--capacities", default="0", help="Max entries per setting, 0 = unlimited")
+    parser.add_argument("--policies", default="lru,fifo")
+    parser.add_argument("--csv", help="Also write results to this CSV file")
+    args = parser.parse_args()
+
+    records = load_trace(args.traces)
+    if not records:
+        print("❌ No records found.")
+        return
+    print(f"📥 Loaded {len(records)} requests")
+
+    capacities = [int(cap) for cap in args.capacities.split(",")]
+    largest_model = max(Counter(r["m"] for r in records).values())
+    if 0 in capacities and largest_model > MAX_UNBOUNDED_REQUESTS:
+        print(f"❌ {largest_model} requests for one model: unlimited capacity is supported up to "
+              f"{MAX_UNBOUNDED_REQUESTS}. Pass explicit --capacities.")
+        return
+
+    start = time.time()
+    embedding_service.initialize()
+    vectors = embedding_service.model.encode(
+        [r["p"] for r in records], batch_size=256, normalize_embeddings=True
+    ).astype(np.float32)
+    print(f"🧠 Embedded in {time.time() - start:.1f}s")
+
+    configs = [
+        Config(float(t), int(cap), policy)
+        for t in args.thresholds.split(",")
+        for cap in args.capacities.split(",")
+        for policy in args.policies.split(",")
+        # FIFO and LRU are identical without eviction
+        if int(cap) or policy == args.policies.split(",")[0]
+    ]
+
+    start = time.time()
+    replay(records, vectors, configs)
+    print(f"🔁 Replayed {len(configs)} settings in {time.time() - start:.1f}s\n")
+
+    header = ["threshold", "capacity", "policy", "hit_rate", "peak_mb", "hits_per_gb", "gpu_s_saved"]
+    rows = []
+    for cfg in configs:
+        peak_gb = cfg.peak_bytes / 1e9
+        rows.append([
+            cfg.threshold,
+            cfg.capacity or "unlimited",
+            cfg.policy if cfg.capacity else "-",
+            f"{cfg.hits / len(records):.3f}",
+            f"{cfg.peak_bytes / 1e6:.1f}",
+            f"{cfg.hits / peak_gb:.0f}" if peak_gb else "-",
+            f"{cfg.gpu_saved:.1f}",
+        ])
+
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+    if args.csv:
+        with open(args.csv, "w") as f:
+            for row in [header] + rows:
+                f.write(",".join(str(x) for x in row) + "\n")
+        print(f"\n✅ Wrote {args.csv}")
+
+if __name__ == "__main__":
+    main()
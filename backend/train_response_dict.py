@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+import zstandard as zstd
+from sqlalchemy.future import select
+from app.database import engine, AsyncSessionLocal
+from app.models import CachedResponse
+from app.services.response_store import response_store, ZSTD_DICT_DIR
+
+# 110 KB is zstd's recommended default; plenty for chat-style completions
+DICT_SIZE = 112640
+SAMPLE_LIMIT = 20000
+
+async def train_dict():
+    # 1. Pull a sample of stored responses (decoded with whatever dict they used)
+    print(f"📥 Reading up to {SAMPLE_LIMIT} cached responses...")
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(CachedResponse.body)
+            .order_by(CachedResponse.created_at.desc())
+            .limit(SAMPLE_LIMIT)
+        )
+        samples = [response_store.decompress(body).encode("utf-8") for body in result.scalars()]
+    await engine.dispose()
+
+    if len(samples) < 100:
+        print(f"❌ Only {len(samples)} responses cached. Need at least 100 to train.")
+        sys.exit(1)
+
+    # 2. Train
+    print(f"🏋️  Training {DICT_SIZE // 1024} KB dictionary on {len(samples)} samples...")
+    dictionary = zstd.train_dictionary(DICT_SIZE, samples)
+
+    # 3. Save as '<dict_id>.zdict'. Newest file is picked up on the next restart;
+    # older dictionaries must be kept so existing rows stay readable.
+    os.makedirs(ZSTD_DICT_DIR, exist_ok=True)
+    path = os.path.join(ZSTD_DICT_DIR, f"{dictionary.dict_id()}.zdict")
+    with open(path, "wb") as f:
+        f.write(dictionary.as_bytes())
+
+    raw = sum(len(s) for s in samples)
+    packed = sum(len(zstd.ZstdCompressor(dict_data=dictionary).compress(s)) for s in samples)
+    print(f"✅ Saved {path} (sample ratio {raw / packed:.2f}x)")
+
+if __name__ == "__main__":
+    asyncio.run(train_dict())